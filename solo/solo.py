@@ -1,15 +1,18 @@
 #!/usr/bin/env python
+import gc
+import hashlib
 import json
 import os
-import umap
 import sys
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import pkg_resources
 
+import numba
 import numpy as np
 from sklearn.metrics import *
-from scipy.special import softmax
+from scipy.special import expit
 from scanpy import read_10x_mtx
+from threadpoolctl import threadpool_limits
 
 import torch
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
@@ -19,7 +22,7 @@ from scvi.data import read_h5ad, read_loom, setup_anndata
 from scvi.model import SCVI
 from scvi.external import SOLO
 
-from .utils import knn_smooth_pred_class
+from .utils import calibrate_doublet_scores, knn_smooth_pred_class
 
 """
 solo.py
@@ -116,6 +119,20 @@ def main():
         action="store_true",
         help="Recalibrate doublet scores (not recommended anymore)",
     )
+    parser.add_argument(
+        "--emit-csv",
+        dest="emit_csv",
+        default=False,
+        action="store_true",
+        help="Also write score and prediction arrays as csv files",
+    )
+    parser.add_argument(
+        "--legacy-output",
+        dest="legacy_output",
+        default=False,
+        action="store_true",
+        help="Also write each score and prediction array to its own npy file",
+    )
     parser.add_argument(
         "--version",
         dest="version",
@@ -138,9 +155,36 @@ def main():
         type=int,
         help="Learning rate used for vae",
     )
+    parser.add_argument(
+        "--precision",
+        dest="precision",
+        default=32,
+        type=int,
+        choices=[16, 32],
+        help="Floating point precision for training, 16 uses mixed \
+                        precision on GPU",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        default=None,
+        type=int,
+        help="Number of CPU threads for numeric libraries, defaults to \
+                        all cores",
+    )
     
     args = parser.parse_args()
 
+    # pin thread pools so numpy/sklearn BLAS and OpenMP threads don't
+    # oversubscribe the cores alongside torch
+    num_threads = args.threads or os.cpu_count()
+    os.environ.setdefault("OMP_NUM_THREADS", str(num_threads))
+    os.environ.setdefault("MKL_NUM_THREADS", str(num_threads))
+    threadpool_limits(limits=num_threads)
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(max(1, num_threads // 2))
+
     if args.version:
         version = pkg_resources.require("solo-sc")[0].version
         print(f"Current version of solo-sc is {version}")
@@ -153,15 +197,25 @@ def main():
     if args.gpu and not torch.cuda.is_available():
         args.gpu = torch.cuda.is_available()
         print("Cuda is not available, switching to cpu running!")
+    if args.precision != 32 and not args.gpu:
+        args.precision = 32
+        print("Mixed precision needs a GPU, switching to 32 bit precision!")
 
-    if not os.path.isdir(args.out_dir):
-        os.mkdir(args.out_dir)
+    os.makedirs(args.out_dir, exist_ok=True)
 
     if args.reproducible_seed is not None:
         scvi.settings.seed = args.reproducible_seed
     else:
         scvi.settings.seed = np.random.randint(10000)
 
+    if args.gpu:
+        # allow TF32 tensor cores for float32 matmuls, same as
+        # torch.set_float32_matmul_precision("high") on newer torch
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        # kernel autotuning is nondeterministic, keep it off for seeded runs
+        torch.backends.cudnn.benchmark = args.reproducible_seed is None
+
     ##################################################
     # data
 
@@ -199,6 +253,32 @@ def main():
     with open(model_json_file, "r") as model_json_open:
         params = json.load(model_json_open)
 
+    # hash of the vae inputs, used to reuse a vae trained by a previous run
+    # with the same parameters and data in the same output directory. the
+    # data is fingerprinted by the size and mtime of its file(s)
+    with open(model_json_file, "rb") as model_json_open:
+        model_hash = hashlib.sha256(model_json_open.read())
+    model_hash.update(os.path.abspath(data_path).encode())
+    if os.path.isdir(data_path):
+        data_files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(data_path)
+            for name in names
+        )
+    else:
+        data_files = [data_path]
+    for data_file in data_files:
+        data_stat = os.stat(data_file)
+        model_hash.update(
+            f"{data_file}:{data_stat.st_size}:{data_stat.st_mtime_ns}".encode()
+        )
+    model_hash.update(
+        f"{args.lr_vae}:{args.reproducible_seed}:{args.precision}".encode()
+    )
+    model_hash = model_hash.hexdigest()
+    model_hash_file = os.path.join(args.out_dir, "model_hash.txt")
+    vae_dir = os.path.join(args.out_dir, "vae")
+
     # set VAE params
     vae_params = {}
     for par in ["n_hidden", "n_latent", "n_layers", "dropout_rate", "ignore_batch"]:
@@ -214,11 +294,19 @@ def main():
     stopping_params = {"patience": params.get("patience", 8), "min_delta": 0}
 
     # protect against single example batch
+    requested_batch_size = batch_size
     while num_cells % batch_size == 1:
         batch_size = int(np.round(1.25 * batch_size))
+    if batch_size != requested_batch_size:
         print("Increasing batch_size to %d to avoid single example batch." % batch_size)
 
     scvi.settings.batch_size = batch_size
+
+    # lightning trainer arguments shared by vae and classifier training
+    trainer_kwargs = {}
+    if args.gpu:
+        trainer_kwargs["precision"] = args.precision
+
     ##################################################
     # SCVI
     setup_anndata(scvi_data, batch_key=batch_key)
@@ -230,9 +318,21 @@ def main():
         use_observed_lib_size=False,
     )
 
+    cached_hash = None
+    if os.path.isdir(vae_dir) and os.path.exists(model_hash_file):
+        with open(model_hash_file, "r") as model_hash_open:
+            cached_hash = model_hash_open.read().strip()
+
     if args.seed:
         vae = vae.load(os.path.join(args.seed, "vae"), use_gpu=args.gpu)
+    elif cached_hash == model_hash:
+        print(f"Reusing previously trained VAE in {vae_dir}")
+        vae = vae.load(vae_dir, adata=scvi_data, use_gpu=args.gpu)
     else:
+        # drop the old hash first so a crash after saving the new vae can't
+        # leave it paired with a stale hash
+        if os.path.exists(model_hash_file):
+            os.remove(model_hash_file)
         scvi_callbacks = []
         scvi_callbacks += [
             EarlyStopping(
@@ -254,9 +354,12 @@ def main():
             check_val_every_n_epoch=check_val_every_n_epoch,
             plan_kwargs=plan_kwargs,
             callbacks=scvi_callbacks,
+            **trainer_kwargs,
         )
         # save VAE
-        vae.save(os.path.join(args.out_dir, "vae"))
+        vae.save(vae_dir, overwrite=True)
+        with open(model_hash_file, "w") as model_hash_open:
+            model_hash_open.write(model_hash)
 
     latent = vae.get_latent_representation()
     # save latent representation
@@ -268,44 +371,66 @@ def main():
     # model
     # todo add doublet ratio
     solo = SOLO.from_scvi_model(vae, doublet_ratio=args.doublet_ratio)
+
+    # the classifier only needs the latent space, release the vae and the
+    # count matrix it holds for the rest of the run
+    del vae, scvi_data
+    gc.collect()
     solo.train(
         2000,
         lr=learning_rate,
         train_size=0.9,
         check_val_every_n_epoch=5,
         early_stopping_patience=6,
+        **trainer_kwargs,
     )
+    # fine tune at a lower learning rate, stopping soon after the validation
+    # loss stops improving since the first stage has already converged
     solo.train(
         2000,
         lr=learning_rate * 0.1,
         train_size=0.9,
         check_val_every_n_epoch=1,
-        early_stopping_patience=30,
+        early_stopping_patience=10,
         callbacks=[],
+        **trainer_kwargs,
     )
-    solo.save(os.path.join(args.out_dir, "classifier"))
-
-    logit_predictions = solo.predict(include_simulated_doublets=True)
 
-    is_doublet_known = solo.adata.obs._solo_doub_sim == "doublet"
-    is_doublet_pred = logit_predictions.idxmin(axis=1) == "singlet"
+    solo.save(os.path.join(args.out_dir, "classifier"))
 
-    validation_is_doublet_known = is_doublet_known[solo.validation_indices]
-    validation_is_doublet_pred = is_doublet_pred[solo.validation_indices]
-    training_is_doublet_known = is_doublet_known[solo.train_indices]
-    training_is_doublet_pred = is_doublet_pred[solo.train_indices]
+    # float32 halves the bytes moved by every per-cell op on the logits below
+    logit_predictions = solo.predict(include_simulated_doublets=True).astype(
+        np.float32
+    )
 
+    # work on the underlying arrays so the split gathers use numpy indexing
+    is_doublet_known = solo.adata.obs._solo_doub_sim.values == "doublet"
+    is_doublet_pred = (
+        logit_predictions["singlet"].values < logit_predictions["doublet"].values
+    )
+    # softmax predictions
+    # for two classes the doublet softmax is the sigmoid of the logit difference
+    doublet_score = expit(logit_predictions["doublet"] - logit_predictions["singlet"])
+
+    train_indices = np.asarray(solo.train_indices)
+    validation_indices = np.asarray(solo.validation_indices)
+    validation_is_doublet_known = is_doublet_known[validation_indices]
+    validation_is_doublet_pred = is_doublet_pred[validation_indices]
+    training_is_doublet_known = is_doublet_known[train_indices]
+    training_is_doublet_pred = is_doublet_pred[train_indices]
+    validation_solo_scores = doublet_score.values[validation_indices]
+    train_solo_scores = doublet_score.values[train_indices]
+
+    # accuracy is on the hard predictions, ranking metrics on the scores
     valid_as = accuracy_score(validation_is_doublet_known, validation_is_doublet_pred)
-    valid_roc = roc_auc_score(validation_is_doublet_known, validation_is_doublet_pred)
+    valid_roc = roc_auc_score(validation_is_doublet_known, validation_solo_scores)
     valid_ap = average_precision_score(
-        validation_is_doublet_known, validation_is_doublet_pred
+        validation_is_doublet_known, validation_solo_scores
     )
 
     train_as = accuracy_score(training_is_doublet_known, training_is_doublet_pred)
-    train_roc = roc_auc_score(training_is_doublet_known, training_is_doublet_pred)
-    train_ap = average_precision_score(
-        training_is_doublet_known, training_is_doublet_pred
-    )
+    train_roc = roc_auc_score(training_is_doublet_known, train_solo_scores)
+    train_ap = average_precision_score(training_is_doublet_known, train_solo_scores)
 
     print(f"Training results")
     print(f"AUROC: {train_roc}, Accuracy: {train_as}, Average precision: {train_ap}")
@@ -314,67 +439,49 @@ def main():
     print(f"AUROC: {valid_roc}, Accuracy: {valid_as}, Average precision: {valid_ap}")
 
     # write predictions
-    # softmax predictions
-    softmax_predictions = softmax(logit_predictions, axis=1)
-    doublet_score = softmax_predictions.loc[:, "doublet"]
-
-    np.save(
-        os.path.join(args.out_dir, "no_updates_softmax_scores.npy"),
-        doublet_score[:num_cells],
-    )
-    np.savetxt(
-        os.path.join(args.out_dir, "no_updates_softmax_scores.csv"),
-        doublet_score[:num_cells],
-        delimiter=",",
-    )
-    np.save(
-        os.path.join(args.out_dir, "no_updates_softmax_scores_sim.npy"),
-        doublet_score[num_cells:],
+    # output arrays, written together to scores.npz at the end of the run
+    scores = {}
+    scores["no_updates_softmax_scores"] = doublet_score[:num_cells].astype("float32")
+    if args.emit_csv:
+        np.savetxt(
+            os.path.join(args.out_dir, "no_updates_softmax_scores.csv"),
+            np.asarray(doublet_score[:num_cells], dtype=np.float32),
+            delimiter=",",
+            fmt="%.6g",
+        )
+    scores["no_updates_softmax_scores_sim"] = doublet_score[num_cells:].astype(
+        "float32"
     )
 
     # logit predictions
     logit_doublet_score = logit_predictions.loc[:, "doublet"]
-    np.save(
-        os.path.join(args.out_dir, "logit_scores.npy"), logit_doublet_score[:num_cells]
-    )
-    np.savetxt(
-        os.path.join(args.out_dir, "logit_scores.csv"),
-        logit_doublet_score[:num_cells],
-        delimiter=",",
-    )
-    np.save(
-        os.path.join(args.out_dir, "logit_scores_sim.npy"),
-        logit_doublet_score[num_cells:],
-    )
+    scores["logit_scores"] = logit_doublet_score[:num_cells].astype("float32")
+    if args.emit_csv:
+        np.savetxt(
+            os.path.join(args.out_dir, "logit_scores.csv"),
+            np.asarray(logit_doublet_score[:num_cells], dtype=np.float32),
+            delimiter=",",
+            fmt="%.6g",
+        )
+    scores["logit_scores_sim"] = logit_doublet_score[num_cells:].astype("float32")
 
     # update threshold as a function of Solo's estimate of the number of
     # doublets
     # essentially a log odds update
-    # TODO put in a function
-    # currently overshrinking softmaxes
-    diff = np.inf
-    counter_update = 0
     solo_scores = doublet_score[:num_cells]
     logit_scores = logit_doublet_score[:num_cells]
     d_s = args.doublet_ratio / (args.doublet_ratio + 1)
     if args.recalibrate_scores:
-        while (diff > 0.01) | (counter_update < 5):
-
-            # calculate log odds calibration for logits
-            d_o = np.mean(solo_scores)
-            c = np.log(d_o / (1 - d_o)) - np.log(d_s / (1 - d_s))
-
-            # update solo scores
-            solo_scores = 1 / (1 + np.exp(-(logit_scores + c)))
-
-            # update while conditions
-            diff = np.abs(d_o - np.mean(solo_scores))
-            counter_update += 1
-
-    np.save(os.path.join(args.out_dir, "softmax_scores.npy"), solo_scores)
-    np.savetxt(
-        os.path.join(args.out_dir, "softmax_scores.csv"), solo_scores, delimiter=","
-    )
+        solo_scores = calibrate_doublet_scores(logit_scores, d_s)
+
+    scores["softmax_scores"] = solo_scores.astype("float32")
+    if args.emit_csv:
+        np.savetxt(
+            os.path.join(args.out_dir, "softmax_scores.csv"),
+            np.asarray(solo_scores, dtype=np.float32),
+            delimiter=",",
+            fmt="%.6g",
+        )
 
     if args.expected_number_of_doublets is not None:
         k = len(solo_scores) - args.expected_number_of_doublets
@@ -385,36 +492,46 @@ def main():
                    -e parameter value"""
             )
         assert k > 0
-        idx = np.argpartition(solo_scores, k)
-        threshold = np.max(solo_scores[idx[:k]])
+        # k-th smallest score, selected without materializing an index array
+        threshold = np.partition(np.asarray(solo_scores), k - 1)[k - 1]
         is_solo_doublet = solo_scores > threshold
     else:
         is_solo_doublet = solo_scores > 0.5
 
-    np.save(os.path.join(args.out_dir, "is_doublet.npy"), is_solo_doublet[:num_cells])
-    np.savetxt(
-        os.path.join(args.out_dir, "is_doublet.csv"),
-        is_solo_doublet[:num_cells],
-        delimiter=",",
-    )
+    scores["is_doublet"] = is_solo_doublet[:num_cells]
+    if args.emit_csv:
+        np.savetxt(
+            os.path.join(args.out_dir, "is_doublet.csv"),
+            is_solo_doublet[:num_cells],
+            delimiter=",",
+            fmt="%d",
+        )
 
-    np.save(
-        os.path.join(args.out_dir, "is_doublet_sim.npy"), is_solo_doublet[num_cells:]
-    )
+    scores["is_doublet_sim"] = is_solo_doublet[num_cells:]
 
-    np.save(os.path.join(args.out_dir, "preds.npy"), is_doublet_pred[:num_cells])
-    np.savetxt(
-        os.path.join(args.out_dir, "preds.csv"),
-        is_doublet_pred[:num_cells],
-        delimiter=",",
-    )
+    scores["preds"] = is_doublet_pred[:num_cells]
+    if args.emit_csv:
+        np.savetxt(
+            os.path.join(args.out_dir, "preds.csv"),
+            is_doublet_pred[:num_cells],
+            delimiter=",",
+            fmt="%d",
+        )
 
     smoothed_preds = knn_smooth_pred_class(
-        X=latent, pred_class=is_doublet_pred[:num_cells]
+        X=np.ascontiguousarray(latent, dtype=np.float32),
+        pred_class=is_doublet_pred[:num_cells],
     )
-    np.save(os.path.join(args.out_dir, "smoothed_preds.npy"), smoothed_preds)
+    scores["smoothed_preds"] = smoothed_preds
+
+    scores = {name: np.asarray(arr) for name, arr in scores.items()}
+    np.savez_compressed(os.path.join(args.out_dir, "scores.npz"), **scores)
+    if args.legacy_output:
+        for name, arr in scores.items():
+            np.save(os.path.join(args.out_dir, f"{name}.npy"), arr)
 
     if args.anndata_output and data_ext == ".h5ad":
+        scvi_data = read_h5ad(data_path)
         scvi_data.obs["is_doublet"] = is_solo_doublet[:num_cells].values.astype(bool)
         scvi_data.obs["logit_scores"] = logit_doublet_score[:num_cells].values.astype(
             float
@@ -428,9 +545,7 @@ def main():
         matplotlib.use("Agg")
         import matplotlib.pyplot as plt
         import seaborn as sns
-
-        train_solo_scores = doublet_score[solo.train_indices]
-        validation_solo_scores = doublet_score[solo.validation_indices]
+        import umap
 
         train_fpr, train_tpr, _ = roc_curve(
             training_is_doublet_known, train_solo_scores
@@ -460,18 +575,20 @@ def main():
         plt.plot(train_recall, train_precision, label="Train")
         plt.plot(val_recall, val_precision, label="Validation")
         plt.gca().set_xlabel("Recall")
-        plt.gca().set_ylabel("pytPrecision")
+        plt.gca().set_ylabel("Precision")
         plt.legend()
         plt.savefig(os.path.join(args.out_dir, "precision_recall.pdf"))
         plt.close()
 
         # plot distributions
-        obs_indices = solo.validation_indices[solo.validation_indices < num_cells]
-        sim_indices = solo.validation_indices[solo.validation_indices > num_cells]
+        # simulated doublets are appended after the observed cells
+        is_obs_validation = validation_indices < num_cells
+        obs_indices = validation_indices[is_obs_validation]
+        sim_indices = validation_indices[~is_obs_validation]
 
         plt.figure()
-        sns.displot(doublet_score[sim_indices], label="Simulated")
-        sns.displot(doublet_score[obs_indices], label="Observed")
+        sns.displot(doublet_score.values[sim_indices], label="Simulated")
+        sns.displot(doublet_score.values[obs_indices], label="Observed")
         plt.legend()
         plt.savefig(os.path.join(args.out_dir, "sim_vs_obs_dist.pdf"))
         plt.close()
@@ -482,7 +599,13 @@ def main():
         plt.savefig(os.path.join(args.out_dir, "real_cells_dist.pdf"))
         plt.close()
 
-        scvi_umap = umap.UMAP(n_neighbors=16).fit_transform(latent)
+        # umap falls back to a single thread when a reproducible seed is given
+        scvi_umap = umap.UMAP(
+            n_neighbors=16,
+            n_jobs=-1,
+            low_memory=False,
+            random_state=args.reproducible_seed,
+        ).fit_transform(latent.astype(np.float32))
         fig, ax = plt.subplots(1, 1, figsize=(10, 10))
         ax.scatter(
             scvi_umap[:, 0],
@@ -1,9 +1,96 @@
+import math
+
 import numpy as np
 
+from numba import njit, prange
+from scipy.optimize import brentq
+from scipy.special import expit, logit
 from scipy.stats import multinomial
 from sklearn.neighbors import NearestNeighbors
 
 
+@njit(parallel=True, cache=True)
+def _knn_majority_vote(neighbor_codes: np.ndarray, n_classes: int) -> np.ndarray:
+    """
+    Majority class code over each row of neighbor class codes. Ties are
+    broken in favor of the smallest code, matching `np.argmax` on the
+    counts of sorted unique classes.
+    """
+    n_cells, n_neighbors = neighbor_codes.shape
+    maj_codes = np.empty(n_cells, dtype=np.int64)
+    for i in prange(n_cells):
+        counts = np.zeros(n_classes, dtype=np.int64)
+        for j in range(n_neighbors):
+            counts[neighbor_codes[i, j]] += 1
+        maj_codes[i] = np.argmax(counts)
+    return maj_codes
+
+
+@njit(
+    parallel=True,
+    fastmath={"nsz", "arcp", "contract", "afn", "reassoc"},
+    cache=True,
+)
+def mean_expit(logits: np.ndarray, shift: float) -> float:
+    """
+    Mean of the logistic sigmoid of shifted logits, computed in a single
+    pass without allocating the [N,] sigmoid array.
+    Parameters
+    ----------
+    logits : np.ndarray
+        [N,] logits.
+    shift : float
+        constant added to every logit before the sigmoid.
+    Returns
+    -------
+    mean : float
+        mean of `expit(logits + shift)`.
+    """
+    total = 0.0
+    for i in prange(logits.shape[0]):
+        total += 1.0 / (1.0 + math.exp(-(logits[i] + shift)))
+    return total / logits.shape[0]
+
+
+def calibrate_doublet_scores(
+    logit_scores: np.ndarray,
+    d_s: float,
+    xtol: float = 1e-3,
+) -> np.ndarray:
+    """
+    Log odds calibration of doublet scores to an expected doublet fraction.
+    Parameters
+    ----------
+    logit_scores : np.ndarray
+        [N,] doublet logits of the observed cells.
+    d_s : float
+        expected fraction of doublets, in (0, 1).
+    xtol : float
+        absolute tolerance on the log odds shift.
+    Returns
+    -------
+    calibrated_scores : np.ndarray
+        [N,] `expit(logit_scores + c)`, with the shift `c` chosen so the
+        mean calibrated score equals `d_s`.
+    Notes
+    -----
+    The mean calibrated score is strictly increasing in `c`. With `c` at
+    `logit(d_s) - max(logit_scores)` it is at most `d_s`, and with `c` at
+    `logit(d_s) - min(logit_scores)` it is at least `d_s`, so that bracket
+    always contains the root. It is padded so its ends have opposite signs
+    even when all logit scores are equal.
+    """
+    logit_d_s = logit(d_s)
+    logit_scores_array = np.ascontiguousarray(logit_scores)
+    c = brentq(
+        lambda c: mean_expit(logit_scores_array, c) - d_s,
+        logit_d_s - np.max(logit_scores_array) - 1,
+        logit_d_s - np.min(logit_scores_array) + 1,
+        xtol=xtol,
+    )
+    return expit(logit_scores + c)
+
+
 def knn_smooth_pred_class(
     X: np.ndarray,
     pred_class: np.ndarray,
@@ -47,6 +134,10 @@ def knn_smooth_pred_class(
         # associations, create a universal pseudogroup `0`.
         grouping = np.zeros(X.shape[0])
 
+    pred_class = np.asarray(pred_class)
+    # encode classes as integer codes so the majority vote can run in numba
+    uniq_classes, class_codes = np.unique(pred_class, return_inverse=True)
+
     smooth_pred_class = np.zeros_like(pred_class)
     for group in np.unique(grouping):
         # identify only cells in the relevant group
@@ -66,9 +157,8 @@ def knn_smooth_pred_class(
 
         # for each cell in the group, assign a class as
         # the majority class of the kNN
-        for i in range(X_group.shape[0]):
-            classes = pred_class[group_idx[idx[i, :]]]
-            uniq_classes, counts = np.unique(classes, return_counts=True)
-            maj_class = uniq_classes[int(np.argmax(counts))]
-            smooth_pred_class[group_idx[i]] = maj_class
+        maj_codes = _knn_majority_vote(
+            class_codes[group_idx[idx]], len(uniq_classes)
+        )
+        smooth_pred_class[group_idx] = uniq_classes[maj_codes]
     return smooth_pred_class
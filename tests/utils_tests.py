@@ -0,0 +1,117 @@
+import pytest
+
+from solo import utils
+
+import numpy as np
+from scipy.special import expit
+from sklearn.neighbors import NearestNeighbors
+
+
+def _reference_knn_smooth_pred_class(X, pred_class, grouping=None, k=15):
+    # per-cell np.unique majority vote, as knn_smooth_pred_class was written
+    # before the vote moved into numba
+    if grouping is None:
+        grouping = np.zeros(X.shape[0])
+
+    smooth_pred_class = np.zeros_like(pred_class)
+    for group in np.unique(grouping):
+        group_idx = np.where(grouping == group)[0].astype("int")
+        X_group = X[grouping == group, :]
+        k_use = min(X_group.shape[0], k)
+        nns = NearestNeighbors(n_neighbors=k_use).fit(X_group)
+        dist, idx = nns.kneighbors(X_group)
+        for i in range(X_group.shape[0]):
+            classes = pred_class[group_idx[idx[i, :]]]
+            uniq_classes, counts = np.unique(classes, return_counts=True)
+            smooth_pred_class[group_idx[i]] = uniq_classes[int(np.argmax(counts))]
+    return smooth_pred_class
+
+
+def test_knn_smooth_pred_class_matches_reference():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(200, 5)).astype(np.float32)
+    pred_class = rng.randint(0, 3, size=200)
+
+    smoothed = utils.knn_smooth_pred_class(X, pred_class, k=7)
+    expected = _reference_knn_smooth_pred_class(X, pred_class, k=7)
+    assert smoothed.dtype == expected.dtype
+    assert all(smoothed == expected)
+
+
+def test_knn_smooth_pred_class_bool():
+    rng = np.random.RandomState(1)
+    X = rng.normal(size=(150, 4)).astype(np.float32)
+    pred_class = rng.rand(150) > 0.7
+
+    smoothed = utils.knn_smooth_pred_class(X, pred_class, k=5)
+    expected = _reference_knn_smooth_pred_class(X, pred_class, k=5)
+    assert smoothed.dtype == bool
+    assert all(smoothed == expected)
+
+
+def test_knn_smooth_pred_class_tie():
+    # every cell sees all four cells, two of each class, ties go to the
+    # smallest class
+    X = np.arange(4, dtype=np.float32).reshape(4, 1)
+    pred_class = np.array([1, 1, 0, 0])
+
+    smoothed = utils.knn_smooth_pred_class(X, pred_class, k=4)
+    expected = _reference_knn_smooth_pred_class(X, pred_class, k=4)
+    assert all(smoothed == expected)
+    assert all(smoothed == 0)
+
+
+def test_knn_smooth_pred_class_grouping():
+    rng = np.random.RandomState(2)
+    X = rng.normal(size=(60, 3)).astype(np.float32)
+    pred_class = rng.randint(0, 2, size=60)
+    # group 2 has fewer cells than k
+    grouping = np.repeat([0, 1, 2], [30, 26, 4])
+
+    smoothed = utils.knn_smooth_pred_class(X, pred_class, grouping=grouping, k=6)
+    expected = _reference_knn_smooth_pred_class(
+        X, pred_class, grouping=grouping, k=6
+    )
+    assert all(smoothed == expected)
+
+
+def test_mean_expit_matches_scipy():
+    rng = np.random.RandomState(3)
+    logits = np.concatenate(
+        [rng.normal(scale=5, size=1000), [-1000.0, -200.0, 200.0, 1000.0]]
+    ).astype(np.float32)
+
+    for shift in [-3.0, 0.0, 0.5, 4.0]:
+        expected = expit(logits.astype(np.float64) + shift).mean()
+        assert utils.mean_expit(logits, shift) == pytest.approx(expected, rel=1e-6)
+
+
+def test_mean_expit_saturates():
+    # exp overflows to inf for very negative logits, giving exactly 0
+    very_negative = np.full(10, -1000.0, dtype=np.float32)
+    very_positive = np.full(10, 1000.0, dtype=np.float32)
+
+    assert utils.mean_expit(very_negative, 0.0) == 0.0
+    assert utils.mean_expit(very_positive, 0.0) == 1.0
+    assert utils.mean_expit(
+        np.concatenate([very_negative, very_positive]), 0.0
+    ) == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize(
+    "logit_scores",
+    [
+        np.random.RandomState(4).normal(loc=-1, scale=3, size=500),
+        np.full(50, 2.5),
+        np.array([-0.7]),
+    ],
+    ids=["normal", "constant", "single_cell"],
+)
+def test_calibrate_doublet_scores(logit_scores):
+    logit_scores = logit_scores.astype(np.float32)
+    d_s = 2 / 3
+    xtol = 1e-3
+
+    calibrated = utils.calibrate_doublet_scores(logit_scores, d_s, xtol=xtol)
+    assert calibrated.shape == logit_scores.shape
+    assert abs(calibrated.mean() - d_s) <= xtol